@@ -2,11 +2,48 @@
 Author : Sarvesh Thakur
 """
 import cv2
+import os
 import time
+import itertools
 import math
+import threading
+from collections import deque
 from queue import Queue
-import keyboard
-from djitellopy import Tello
+import numpy as np
+import av
+from pynput import keyboard as kb
+from djitellopy import Tello, TelloException
+
+# Indices into the RC velocity array, in send_rc_control argument order
+_LR, _FB, _UD, _YAW = range(4)
+
+# command -> (RC velocity index, value) for commands that only change the RC velocities
+_VELOCITY_COMMANDS = {
+    "up": (_UD, 60),
+    "down": (_UD, -60),
+    "left": (_YAW, -60),
+    "right": (_YAW, 60),
+    "a": (_LR, -60),
+    "d": (_LR, 60),
+    "w": (_FB, 60),
+    "z": (_FB, -60),
+}
+
+# pynput special keys -> command, character keys map to their lower case character
+_SPECIAL_KEYS = {
+    kb.Key.up: "up",
+    kb.Key.down: "down",
+    kb.Key.left: "left",
+    kb.Key.right: "right",
+}
+
+# command -> one shot action taking the FlightControl instance
+_ACTION_COMMANDS = {
+    "s": lambda fc: fc.tello.takeoff(),
+    "p": lambda fc: fc.orderSnap(),
+    "c": lambda fc: fc.capturePanorama("C"),
+    "o": lambda fc: fc.capturePanorama("O"),
+}
 
 
 def printHelper():
@@ -39,6 +76,124 @@ def printHelper():
     """)
 
 
+class PanoramaState:
+    """
+    Progress of a panorama capture: n shots, rotating step degrees between them.
+    Phases start with RESIZE (waiting for the 720p stream) when the resolution was changed, then cycle
+    SNAP -> WAIT (rotation to the next shot) -> SNAP ... and end with RETURN (rotation back home).
+    """
+
+    def __init__(self, n, step, resizedFrom=None):
+        self.n = n
+        self.step = step
+        self.i = 0  # shots taken so far
+        self.phase = "SNAP" if resizedFrom is None else "RESIZE"
+        self.resizedFrom = resizedFrom  # frame shape before the resolution change
+        self.t0 = time.monotonic()  # time the panorama was ordered
+        self.rotation = None  # worker thread of the rotation in progress
+
+
+class LiveEdgeFrameRead:
+    """
+    Replacement for djitellopy's BackgroundFrameRead that only demuxes H.264 packets in the background. Packets are
+    decoded on demand by read(), starting from the most recent keyframe, so frames nobody asks for (e.g. while the
+    main loop is busy) are never decoded and reading resumes at the live edge of the stream.
+    """
+
+    def __init__(self, address, maxPackets=120, timeout=3.0, retries=3):
+        self.container = self._open(address, timeout, retries)
+        self.stream = self.container.streams.video[0]
+        self.frame = None  # Until the first keyframe is decoded
+        self.stopped = False
+        self.maxPackets = maxPackets
+        self._packets = deque()
+        self._waitKeyframe = True  # Packets are only queued from a keyframe on
+        self._lock = threading.Lock()
+        self._arrived = threading.Condition(self._lock)  # notified by the demux thread whenever a packet is queued
+        threading.Thread(target=self._demuxLoop, daemon=True).start()
+
+    @staticmethod
+    def _open(address, timeout, retries):
+        # The stream can take a moment to start after streamon, retry like djitellopy's get_frame_read
+        for attempt in range(retries):
+            try:
+                # timeout applies to opening and to every read, so demuxing never blocks for longer than that
+                return av.open(address, timeout=(timeout, timeout),
+                               options={"fflags": "nobuffer", "flags": "low_delay"})
+            except av.error.FFmpegError as e:
+                print("[LiveEdgeFrameRead]: [_open]: Attempt {} to open {} failed : {}".format(attempt + 1, address, e))
+        raise TelloException("Failed to grab video frames from video stream")
+
+    def _demuxLoop(self):
+        while not self.stopped:
+            try:
+                for packet in self.container.demux(self.stream):
+                    if self.stopped:
+                        break
+                    if packet.size == 0:
+                        continue
+                    with self._lock:
+                        if packet.is_keyframe:
+                            self._packets.clear()  # Nothing after a keyframe references the packets before it
+                            self._waitKeyframe = False
+                        elif self._waitKeyframe:
+                            continue
+                        elif len(self._packets) >= self.maxPackets:
+                            # Evicting the oldest packets would lose the keyframe the rest depend on, drop the whole
+                            # GOP and resume at the next keyframe
+                            self._packets.clear()
+                            self._waitKeyframe = True
+                            continue
+                        self._packets.append(packet)
+                        self._arrived.notify()
+                break  # Stopped or end of stream
+            except av.error.FFmpegError:
+                pass  # Read timed out (e.g. after streamoff), check stopped again
+        self.container.close()
+
+    def read(self, timeout=0, budget=0.01):
+        """
+        Decode buffered packets for up to budget seconds and keep the last decoded picture in self.frame.
+        :param timeout: seconds to wait for packets when none are buffered
+        :param budget: decode time in seconds, packets left over are decoded by the next read
+        :return: True if a new picture was decoded
+        """
+        with self._arrived:
+            if not self._packets and timeout > 0:
+                self._arrived.wait(timeout)
+        deadline = time.monotonic() + budget
+        last = None
+        while time.monotonic() < deadline:
+            with self._lock:
+                if not self._packets:
+                    break
+                packet = self._packets.popleft()
+            try:
+                for decoded in self.stream.codec_context.decode(packet):
+                    last = decoded
+            except av.error.FFmpegError as e:
+                # The rest of the GOP references the corrupt packet, resume decoding at the next keyframe
+                print("[LiveEdgeFrameRead]: [read]: Dropping GOP after decode error : {}".format(e))
+                with self._lock:
+                    self._packets.clear()
+                    self._waitKeyframe = True
+                return False
+        if last is not None:
+            self.frame = last.to_ndarray(format="bgr24")  # Only the picture actually used is converted
+            return True
+        return False
+
+    def pending(self):
+        """
+        :return: number of packets demuxed but not yet decoded, 0 once read() has caught up with the live edge
+        """
+        with self._lock:
+            return len(self._packets)
+
+    def stop(self):
+        self.stopped = True  # The demux thread closes the container once it sees this
+
+
 class FlightControl:
     """
     Class is responsible for initialization, in-flight and post-flight control.
@@ -50,8 +205,14 @@ class FlightControl:
         self.tello = None
         self.frameObject = None
         self.frame = None
-        self.outputDir = "output\\"
-        self.FOV = 30  # assuming 75 degrees FOV of Tello EDU
+        self.newFrame = False  # True if the last getFrame returned a frame not seen before
+        self.frameTime = 0.0  # time.monotonic() at which the current frame was decoded
+        self.outputDir = "output"
+        self.outputFolders = ("snaps", "panorama")
+        self._paths = {}  # output folder -> path prefix, filled by init()
+        self._snapIndex = itertools.count()  # Keeps snaps taken within the same second from overwriting each other
+        self.FOV = 82  # horizontal FOV of Tello EDU in degrees
+        self.panoramaOverlap = 0.3  # fraction of each panorama frame shared with the next one, needed for stitching
 
         # To avoid multiple snaps when requested only once (It seems key pressed time is longer than the processing
         # time of while loop asking for user input Hence user's one time key press is actually processed more than
@@ -60,191 +221,357 @@ class FlightControl:
         self.videoOrdered = False  # Implemented after Panorama mode works
         self.videoOutputName = None  # Implemented after Panorama mode works
 
-        # Keep track of actions requested by the user
-        self.ActionStack = []
-        self.timeDifference = 0.2  # time between consecutive actions be greater than 100ms
+        # Debounce: a command is accepted again only once timeDifference seconds have passed since it was last accepted
+        self.timeDifference = 0.2
+        self._timeDifferenceNs = int(self.timeDifference * 1e9)
+        self._lastAccepted = {}  # command -> time.monotonic_ns() at which it was last accepted
 
         # Panorama
         self.panoramaOrdered = False
         self.panoramaDeg = 0
         self.totalPanoramaCaptures = 0
         self.panoramaQueue = Queue(maxsize=0)  # Stores all the frames required to create a panorama
+        self._panorama = None  # PanoramaState of the capture in progress, advanced by capturePanorama_
+        self.resizeTimeout = 3.0  # seconds to wait for the stream to switch resolution before the first shot
+        self.yawRate = 60  # degrees per second, conservative Tello rotation speed used to scale rotation timeouts
+        self.rotateSettle = 0.5  # seconds for the picture to stop swaying once Tello reports a rotation complete
+        self._rotationDoneTime = 0.0  # time.monotonic() at which Tello acknowledged the last rotation
+
+        # JPEG encoding and disk writes happen on a worker thread, the control loop only queues the frame. Frames are
+        # queued by reference: the reader decodes every frame into a new array and nothing here writes into a frame,
+        # so a queued frame never changes under the writer.
+        self._writeQueue = Queue(maxsize=0)
+        threading.Thread(target=self._writerLoop, daemon=True).start()
+
+        self._rc = np.zeros(4, dtype=np.int16)  # left_right, front_back, up_down, yaw velocities
+
+        # RC packets are only sent when the velocities change, plus a keepalive so Tello does not time out
+        self._lastRc = None
+        self._lastRcTime = 0.0
+        self.rcKeepalive = 0.1  # seconds
 
         self.HeavyMode = False  # This mode is entered when a event such as panorama capture or reconstruction is
         # entered. Allows bypassing modes other than quit(Q).
 
+        # Keyboard input is event driven: the pynput listener started in init() keeps the set of held command keys
+        # and queues one shot commands (s, p, c, o), the main loop pops one command per iteration instead of polling
+        # every key.
+        self._heldKeys = set()
+        self._commandQueue = deque(maxlen=4)
+        self._commandLock = threading.Lock()
+        self.quitOrdered = False
+        self._listener = None
+
     def init(self):
+        # Create output folders up front so a misconfigured outputDir fails before take off rather than per snap
+        for folderName in self.outputFolders:
+            path = os.path.join(self.outputDir, folderName)
+            os.makedirs(path, exist_ok=True)
+            if not os.access(path, os.W_OK):
+                raise PermissionError("Output folder {} is not writable".format(path))
+            self._paths[folderName] = path + os.sep
+
         self.tello = Tello()
         self.tello.connect()
-        self.setAllVelocity(0)
+        self.setAllVelocity()
+        # Low resolution and bitrate keep the stream close to the live edge in control mode; 720p at full bitrate is
+        # reserved for HeavyMode captures.
+        self._setVideo(self.tello.set_video_resolution, Tello.RESOLUTION_480P)
+        self._setVideo(self.tello.set_video_bitrate, Tello.BITRATE_1MBPS)
+        self._setVideo(self.tello.set_video_fps, Tello.FPS_30)
         self.tello.streamon()
+        self.frameObject = LiveEdgeFrameRead(self.tello.get_udp_video_address())
+        deadline = time.monotonic() + 5.0
+        while not self.waitFrame():  # Frame size follows the stream, so wait for the first real frame
+            if time.monotonic() > deadline:
+                raise TelloException("No video frame decoded from video stream")
         self.tello.get_battery()
+        self._listener = kb.Listener(on_press=self._onPress, on_release=self._onRelease)
+        self._listener.start()
 
     def deinit(self):
+        self._listener.stop()
+        self._writeQueue.join()  # Let pending snaps reach the disk
+        self.frameObject.stop()
         self.tello.streamoff()
         self.tello.end()
         time.sleep(1.0)  # Let it cool down
 
-    def setAllVelocity(self, val):
-        self.tello.front_back_velocity = 0
-        self.tello.left_right_velocity = 0
-        self.tello.up_down_velocity = 0
-        self.tello.yaw_velocity = 0
-        self.tello.speed = 0
+    def _setVideo(self, setter, value):
+        """
+        Apply a video setting. setresolution, setbitrate and setfps are only known to newer firmware, older firmware
+        rejects them and keeps streaming with its defaults.
+        :param setter: Tello method applying the setting
+        :param value: value of the setting
+        :return: True if Tello accepted the setting
+        """
+        try:
+            setter(value)
+            return True
+        except TelloException as e:
+            print("[FlightControl]: [_setVideo]: {}({}) not supported : {}".format(setter.__name__, value, e))
+            return False
+
+    def setAllVelocity(self):
+        self._rc.fill(0)
 
     def getFrame(self):
         _ = self._readFrame()
         return self._getFrame()
 
+    def waitFrame(self, timeout=0.05):
+        """
+        Block until a new frame is decoded, so the main loop is paced by the stream instead of spinning.
+        :param timeout: seconds to wait at most, keeps the loop (and RC keepalive) going if the stream stalls
+        :return: True if self.frame holds a new frame
+        """
+        self.frameObject.read(timeout)
+        self._getFrame()
+        return self.newFrame
+
     def _readFrame(self):
-        self.frameObject = self.tello.get_frame_read()
+        self.frameObject.read()
         return self.frameObject
 
     def _getFrame(self):
-        self.frame = self.frameObject.frame
+        frame = self.frameObject.frame
+        self.newFrame = frame is not self.frame  # The reader stores every decoded frame in a new array
+        if self.newFrame:
+            self.frameTime = time.monotonic()
+        self.frame = frame
         return self.frame
 
-    def getKeyboardInput(self):
-        commands = ["up", "down", "a", "d", "w", "z", "left", "right", "p", "c"]
-        # wait key command should be given only single time, otherwise delay!
-        if cv2.waitKey(1) & keyboard.is_pressed("s"):
-            self.updateActionTrack("s")  # Update action track
-            return "s"
-        else:
-            for key in commands:
-                if keyboard.is_pressed(key):
-                    self.updateActionTrack(key)  # Update action track
-                    return key
-            return None
+    @staticmethod
+    def _keyName(key):
+        name = _SPECIAL_KEYS.get(key)
+        if name is None:
+            char = getattr(key, "char", None)
+            name = char.lower() if char else None
+        return name
+
+    def _onPress(self, key):
+        # called from the pynput listener thread
+        name = self._keyName(key)
+        if name == "q":
+            self.quitOrdered = True
+            return
+        if name not in _VELOCITY_COMMANDS and name not in _ACTION_COMMANDS:
+            return
+        with self._commandLock:
+            if name in self._heldKeys:  # OS auto repeat while the key is held
+                return
+            self._heldKeys.add(name)
+            if name in _ACTION_COMMANDS:
+                self._commandQueue.append(name)
+
+    def _onRelease(self, key):
+        # called from the pynput listener thread
+        name = self._keyName(key)
+        with self._commandLock:
+            self._heldKeys.discard(name)
+
+    def getHeldKeys(self):
+        with self._commandLock:
+            return tuple(self._heldKeys)
 
-    def updateActionTrack(self, key):
-        if key is not None:
-            self.ActionStack.append((key, time.time()))
-        return True  # figure out use later
+    def getKeyboardInput(self):
+        """
+        :return: next one shot command requested by the user, None if there is none. Velocity keys are not queued,
+        they are read by calculateAction from the held keys.
+        """
+        with self._commandLock:
+            key = self._commandQueue.popleft() if self._commandQueue else None
+        return key
 
     def calculateAction(self, command):
-        valid_command = self.checkValidCommand(command)
-
-        if valid_command:
-            if command is None:
-                self.setAllVelocity(0)
-            elif command == "s":
-                self.tello.takeoff()
-            elif command == "up":
-                self.tello.up_down_velocity = 60
-            elif command == "down":
-                self.tello.up_down_velocity = -60
-            elif command == "left":
-                self.tello.yaw_velocity = -60
-            elif command == "right":
-                self.tello.yaw_velocity = 60
-            elif command == "a":
-                self.tello.left_right_velocity = -60
-            elif command == "d":
-                self.tello.left_right_velocity = 60
-            elif command == "w":
-                self.tello.front_back_velocity = 60
-            elif command == "z":
-                self.tello.front_back_velocity = -60
-            elif command == "p":
-                self.snapOrdered = True
-                self.takeSnap()
-            elif command == "c":
-                self.capturePanorama("C")
+        # Velocities last as long as their keys are held down
+        self.setAllVelocity()
+        for key in self.getHeldKeys():
+            velocity = _VELOCITY_COMMANDS.get(key)
+            if velocity is not None:
+                self._rc[velocity[0]] = velocity[1]
+
+        # One shot commands are bypassed in HeavyMode, they must not be sent while a rotation is waiting on Tello
+        if command is not None and not self.HeavyMode and self.checkValidCommand(command):
+            _ACTION_COMMANDS[command](self)
 
     def checkValidCommand(self, command):
         if command is None:
             return True
-        # Get two recent commands requested and compare time.
-        if len(self.ActionStack) >= 2:
-            last = self.ActionStack[-1]
-            second_last = self.ActionStack[-2]
-            diff = last[1] - second_last[1]
-            # print(last, second_last, diff, self.timeDifference)
-            if (last[0] == second_last[0]) & (diff < self.timeDifference):
-                return False
+        now = time.monotonic_ns()
+        last = self._lastAccepted.get(command)
+        if last is not None and now - last < self._timeDifferenceNs:
+            return False
+        self._lastAccepted[command] = now
         return True
 
     def capturePanorama(self, degree="C"):
+        if self._panorama is not None:  # A panorama is already being captured
+            return
 
         self.panoramaOrdered = True
         self.HeavyMode = True
+        resized = self._setVideo(self.tello.set_video_resolution, Tello.RESOLUTION_720P)
+        self._setVideo(self.tello.set_video_bitrate, Tello.BITRATE_AUTO)
 
         if degree == "C":
             self.panoramaDeg = 180
         elif degree == "O":
             self.panoramaDeg = 360
 
-        self.totalPanoramaCaptures = max(math.floor(self.panoramaDeg / self.FOV), math.floor(self.panoramaDeg / self.FOV) + 1)
-        deg_to_rotate = self.FOV
-        self.capturePanorama_(deg_to_rotate, self.totalPanoramaCaptures)
+        step = self.FOV * (1 - self.panoramaOverlap)
+        self.totalPanoramaCaptures = math.ceil(self.panoramaDeg / step)
+        deg_to_rotate = round(self.panoramaDeg / self.totalPanoramaCaptures)  # Tello only accepts whole degrees
+        print("[capturePanorama] : #Photos : {} , Degree : {} ".format(self.totalPanoramaCaptures, deg_to_rotate))
+        self._panorama = PanoramaState(self.totalPanoramaCaptures, deg_to_rotate,
+                                       self.frame.shape if resized else None)
 
+    def capturePanorama_(self, folder="panorama"):
+        """
+        Advance the panorama capture ordered by capturePanorama by one step. Called once per main loop iteration so
+        video and quit keep being serviced while the drone rotates.
+        :param folder: Name of the folder for output
+        :return: void (updates queue with panorama images, stitched panorama is written by the writer thread)
+        """
+        p = self._panorama
+        if p is None:
+            return
+
+        if p.phase == "RESIZE":
+            # Frames decoded before the new resolution reaches the decoder are still the old size
+            if self.frame.shape == p.resizedFrom and time.monotonic() - p.t0 < self.resizeTimeout:
+                return
+            p.phase = "SNAP"
+            return
+
+        if p.phase == "SNAP":
+            self.panoramaQueue.put(self.frame)
+            p.i += 1
+            if p.i < p.n:
+                p.rotation = self.rotateAsync(p.step)
+                p.phase = "WAIT"
+            else:
+                p.rotation = self.rotateAsync(-(p.n - 1) * p.step)  # Get back to the original orientation
+                p.phase = "RETURN"
+            return
+
+        # WAIT or RETURN: let the rotation finish
+        if p.rotation.is_alive():
+            return
+        if p.phase == "WAIT":
+            # Shoot only once the picture stopped swaying, on a frame decoded after that from the live edge
+            if self.frameTime < self._rotationDoneTime + self.rotateSettle or self.frameObject.pending():
+                return
+            p.phase = "SNAP"
+            return
+
+        frames = [self.panoramaQueue.get() for _ in range(self.panoramaQueue.qsize())]
+        self._writeQueue.put((self._stitchPanorama, frames, folder))
+
+        self._panorama = None
         self.totalPanoramaCaptures = 0
+        self._setVideo(self.tello.set_video_resolution, Tello.RESOLUTION_480P)
+        self._setVideo(self.tello.set_video_bitrate, Tello.BITRATE_1MBPS)
         self.HeavyMode = False
         self.panoramaOrdered = False
 
-    def capturePanorama_(self, deg_to_rotate, n, folder="panorama"):
+    def rotate(self, degrees):
         """
-        Rotate at deg_to_rotate degrees each time and capture n images.
-        :param folder: Name of the folder for output
-        :param deg_to_rotate: rotation in degree
-        :param n : total images to capture
-        :return: void (updates queue with panorama images)
+        Rotate and block until Tello reports the rotation as complete. Video is not pulled meanwhile, use rotateAsync
+        from the main loop.
+        :param degrees: rotation in degree, positive is counter-clockwise
+        :return: result reported by Tello
         """
-        print("[capturePanorama_] : #Photos : {} , Degree : {} ".format(n, deg_to_rotate))
-        # capture, rotate and capture
-        self.takeSnap_("panoramas")
-        time.sleep(0.2)
-
-        action_taken = True
-        for i in range(n-1):
-            self.rotate(deg_to_rotate)
-            self.takeSnap_("panoramas")
-
-        action_taken = self.rotate(-(n - 1) * deg_to_rotate)  # Get back to the original orientation
-        return action_taken
-
-
-    def rotate(self, degrees):
         print("[FlightControl] : [rotate] : To rotate by {} degrees".format(degrees))
-        self.setAllVelocity(0)
-        time.sleep(0.1)
+        self.setAllVelocity()
 
-        if degrees >= 0:
-            result = self.tello.rotate_counter_clockwise(degrees)
-            time.sleep(3)
-        else:
-            result = self.tello.rotate_clockwise(-1 * degrees)
-            time.sleep(3)
+        # Tello only answers once the rotation is complete, so the wait grows with the angle
+        command = "ccw {}" if degrees >= 0 else "cw {}"
+        timeout = Tello.RESPONSE_TIMEOUT + abs(degrees) / self.yawRate
+        try:
+            result = self.tello.send_control_command(command.format(abs(degrees)), timeout=timeout)
+        except TelloException as e:
+            result = e
+        self._rotationDoneTime = time.monotonic()
 
         print("[FlightControl] : [rotate] : Rotate by {} degrees : {}".format(degrees, result))
         return result
 
+    def rotateAsync(self, degrees):
+        """
+        Run rotate on a worker thread so the main loop keeps pulling video while the drone turns.
+        :param degrees: rotation in degree, positive is counter-clockwise
+        :return: worker thread, alive until Tello reports the rotation as complete
+        """
+        worker = threading.Thread(target=self.rotate, args=(degrees,), daemon=True)
+        worker.start()
+        return worker
+
+    def _snapName(self, folderName):
+        return "{}{}_{:04d}.jpg".format(self._paths[folderName], time.strftime("%Y%m%d_%H%M%S"), next(self._snapIndex))
+
+    def orderSnap(self):
+        self.snapOrdered = True
+        self.takeSnap()
+
     def takeSnap(self, folderName="snaps"):
         if self.snapOrdered:
-            t = time.localtime()
-            name = self.outputDir + folderName + "\\" + str(t) + ".jpg"
-            cv2.imwrite(name, self.frame)
-            print("[FlightControl]: [takeSnap]: Snap saved at {}".format(name))
+            self._writeQueue.put((self._saveSnap, self.frame, folderName))
             self.snapOrdered = False
 
-    # called by methods like panorama, reconstruction etc.
-    def takeSnap_(self, folderName="panoramas"):
-        frame = self.getFrame()
-        t = time.localtime()
-        name = self.outputDir + folderName + "\\" + str(t) + ".jpg"
-        cv2.imwrite(name, self.frame)
-        print("[FlightControl]: [takeSnap]: Snap saved at {}".format(name))
-        time.sleep(1)
+    def _writerLoop(self):
+        # Each job is (function, frame(s), output folder). Output names are built here to keep the wall clock
+        # lookup off the control thread.
+        while True:
+            job, frames, folderName = self._writeQueue.get()
+            try:
+                job(frames, folderName)
+            except Exception as e:  # a failed job must not kill the writer, deinit() waits on the queue
+                print("[FlightControl]: [_writerLoop]: Failed to save to {} : {}".format(folderName, e))
+            finally:
+                self._writeQueue.task_done()
+
+    def _saveFrame(self, frame, name):
+        ok, buf = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, 85, cv2.IMWRITE_JPEG_OPTIMIZE, 0,
+                                               cv2.IMWRITE_JPEG_PROGRESSIVE, 0])
+        if not ok:
+            print("[FlightControl]: [_saveFrame]: Could not encode {}".format(name))
+            return
+        try:
+            fd = os.open(name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                os.write(fd, buf)  # buf is a contiguous uint8 array, written through the buffer protocol without a copy
+            finally:
+                os.close(fd)
+        except OSError as e:
+            print("[FlightControl]: [_saveFrame]: Could not write {} : {}".format(name, e))
+            return
+        print("[FlightControl]: [_saveFrame]: Snap saved at {}".format(name))
+
+    def _saveSnap(self, frame, folderName):
+        self._saveFrame(frame, self._snapName(folderName))
+
+    def _stitchPanorama(self, frames, folderName):
+        # Panorama mode uses spherical warping, graph cut seams and multi band blending
+        stitcher = cv2.Stitcher.create(cv2.Stitcher_PANORAMA)
+        status, panorama = stitcher.stitch(frames)
+        if status != cv2.Stitcher_OK:
+            print("[FlightControl]: [_stitchPanorama]: Stitching {} frames failed : {}".format(len(frames), status))
+            return
+        self._saveFrame(panorama, self._snapName(folderName))
 
     def takeAction(self, land=False):
         if not land:
             if not self.HeavyMode:  # If already in a heavy mode, let it complete!
-                self.tello.send_rc_control(self.tello.left_right_velocity, \
-                                           self.tello.front_back_velocity, \
-                                           self.tello.up_down_velocity, \
-                                           self.tello.yaw_velocity)
+                rc = self._rc.tolist()
+                now = time.monotonic()
+                if rc != self._lastRc or now - self._lastRcTime > self.rcKeepalive:
+                    self.tello.send_rc_control(*rc)
+                    self._lastRc = rc
+                    self._lastRcTime = now
         else:
-            self.setAllVelocity(0)
+            if self._panorama is not None and self._panorama.rotation is not None:
+                self._panorama.rotation.join()  # Let Tello acknowledge the rotation before sending land
+            self.setAllVelocity()
             self.tello.land()
             time.sleep(1)
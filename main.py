@@ -11,16 +11,30 @@ if __name__ == "__main__":
 
     fc.init()
 
-    while True:
-        frame = fc.getFrame()
-        cv2.imshow("I am DJI Tello EDU", frame)
+    # pollKey (OpenCV >= 4.5) pumps the window without waitKey's 1ms sleep
+    poll_key = getattr(cv2, "pollKey", lambda: cv2.waitKey(1))
 
-        if cv2.waitKey(1) and keyboard.is_pressed('q'):
+    frame_ix = 0
+    while True:
+        new_frame = fc.waitFrame()  # Paces the loop at the stream's frame rate
+        frame = fc.frame
+        # Display a downscaled preview of every other new frame, full resolution frame is kept for snaps
+        if new_frame:
+            if frame_ix & 1:
+                preview = cv2.resize(frame, (480, 360), interpolation=cv2.INTER_NEAREST)
+                cv2.imshow("I am DJI Tello EDU", preview)
+            frame_ix += 1
+
+        # Flight keys and quit are delivered by the pynput listener, the window only reports 'q' when it has focus
+        window_key = poll_key() & 0xFF
+
+        if fc.quitOrdered or window_key == ord('q'):
             fc.takeAction(land=True)
             break
         else:
             key = fc.getKeyboardInput()
             fc.calculateAction(key)
+            fc.capturePanorama_()  # Advances a panorama in progress by one step
             fc.takeAction()
 
 